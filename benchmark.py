@@ -0,0 +1,384 @@
+"""
+Benchmarks and load tests for the hot paths of Promotion!!, runnable without a Discord connection.
+Run it with `python benchmark.py` from the folder where `promotion.py` is, `python benchmark.py --help` for the options.
+
+Every workload drives the bot's real code with lightweight fake servers, members, roles and channels,
+and a channel send that does nothing. Results can be saved with --save and compared against with --compare,
+so a slowdown between commits shows up before it gets deployed.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from array import array
+from timeit import repeat
+
+import discord
+from discord.state import ConnectionState
+
+import promotion
+
+# Fake Discord objects, with just the attributes the bot uses.
+class FakeRole:
+    __slots__ = ("id", "mention", "name")
+
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.mention = f"<@&{role_id}>"
+        self.name = f"Role {role_id}"
+
+    def __str__(self):
+        return self.name
+
+class FakeChannel:
+    __slots__ = ("id", "mention")
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+
+    # Stub send, so only the bot's own work gets measured.
+    async def send(self, message: str):
+        pass
+
+class FakeGuild:
+    __slots__ = ("id", "name", "roles", "channels")
+
+    def __init__(self, guild_id: int, role_ids, channel_ids):
+        self.id = guild_id
+        self.name = f"Server {guild_id}"
+        self.roles = {role_id: FakeRole(role_id) for role_id in role_ids}
+        self.channels = {channel_id: FakeChannel(channel_id) for channel_id in channel_ids}
+
+    def get_role(self, role_id: int):
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+class FakeMember:
+    __slots__ = ("guild", "id", "name", "display_name", "mention", "_roles")
+
+    def __init__(self, guild: FakeGuild, member_id: int, role_ids):
+        self.guild = guild
+        self.id = member_id
+        self.name = f"user{member_id}"
+        self.display_name = f"User {member_id}"
+        self.mention = f"<@{member_id}>"
+        # The same sorted array of role IDs py-cord keeps.
+        self._roles = array("Q", sorted(role_ids))
+
+class FakeContext:
+    __slots__ = ("guild", "channel")
+
+    def __init__(self, guild: FakeGuild, channel: FakeChannel):
+        self.guild = guild
+        self.channel = channel
+
+    async def respond(self, *args, **kwargs):
+        pass
+
+# The way messages were rendered before templates, kept here to compare against.
+def render_with_re_sub(message, after, role):
+    special_tokens = {"{user_mention}": after.mention,
+                      "{user_tag}": after.name,
+                      "{user_name}": after.display_name,
+                      "{user_id}": after.id,
+                      "{role_mention}": role.mention,
+                      "{role_name}": str(role),
+                      "{role_id}": role.id}
+    for x in special_tokens.keys():
+        message = re.sub(x, str(special_tokens[x]), message)
+    return message
+
+MESSAGES = {
+    "default": "{user_mention} got the {role_name} role!! 🎉",
+    "every token": "{user_mention} {user_tag} {user_name} {user_id} {role_mention} {role_name} {role_id}",
+    "no tokens": "Someone got a role!! 🎉",
+}
+
+# Server, role and channel IDs start here. Real snowflakes are this big too.
+GUILD_BASE = 10 ** 17
+ROLE_BASE = 2 * 10 ** 17
+CHANNEL_BASE = 3 * 10 ** 17
+
+# Start every workload from a clean bot, with storage pointed at a temporary folder so nothing real gets touched.
+def reset_bot(directory: str):
+    promotion.assignments = promotion.AssignmentIndex()
+    promotion.storage = promotion.JsonStorage(f"{directory}/")
+    promotion.dispatcher = promotion.Dispatcher(promotion.MAX_CONCURRENT_SENDS, promotion.MAX_SEND_RETRIES)
+    promotion.dedup = promotion.DedupCache(promotion.DEDUP_TTL, promotion.DEDUP_MAX_SIZE)
+    promotion.coalescer = promotion.Coalescer(promotion.COALESCE_WINDOW)
+    promotion.flush_lock = asyncio.Lock()
+    promotion.flush_task = None
+    promotion.dirty_guilds.clear()
+    promotion.events_seen = promotion.RateMeter()
+    promotion.events_matched = promotion.RateMeter()
+
+# The json format for `guilds` servers with `roles` watched roles each, every role announced in one channel.
+def synthetic_mappings(guilds: int, roles: int) -> dict:
+    return {str(GUILD_BASE + g): {str(ROLE_BASE + g * roles + r): {str(CHANNEL_BASE + g): ["{user_mention} got the {role_name} role!! 🎉"]}
+                                  for r in range(roles)}
+            for g in range(guilds)}
+
+# Every workload is an async function that takes the options and a temporary folder,
+# and returns a list of latencies in seconds plus the number of operations they cover.
+
+# A storm of member updates: a quarter in servers without assignments, half without any role change,
+# some adding a role nobody watches, and a tenth adding a watched role.
+async def member_update_storm(options, directory: str):
+    promotion.assignments.load_lazily(synthetic_mappings(options.guilds, options.roles))
+    rng = random.Random(1)
+    guilds = {}
+    latencies = []
+    for i in range(options.updates):
+        kind = rng.random()
+        # Servers past the ones with assignments don't have any.
+        guild_index = rng.randrange(options.guilds) + (options.guilds if kind < 0.25 else 0)
+        guild = guilds.get(guild_index)
+        if guild is None:
+            role_ids = [ROLE_BASE + guild_index * options.roles + r for r in range(options.roles)] + [1, 2]
+            guild = guilds[guild_index] = FakeGuild(GUILD_BASE + guild_index, role_ids, [CHANNEL_BASE + guild_index])
+        if kind < 0.75:
+            added = []
+        elif kind < 0.9:
+            added = [2]
+        else:
+            added = [ROLE_BASE + guild_index * options.roles + rng.randrange(options.roles)]
+        before = FakeMember(guild, i, [1])
+        after = FakeMember(guild, i, [1] + added)
+        started = time.perf_counter()
+        await promotion.on_member_update(before, after)
+        latencies.append(time.perf_counter() - started)
+    await promotion.dispatcher.drain(timeout=60)
+    return latencies, options.updates
+
+# /assign, over and over, spread across servers.
+async def assign_commands(options, directory: str):
+    promotion.SAVE_DELAY = 3600
+    callback = promotion.assign_role_and_channel.callback
+    contexts = []
+    for g in range(min(options.guilds, options.assigns)):
+        guild = FakeGuild(GUILD_BASE + g, [], [CHANNEL_BASE + g])
+        contexts.append(FakeContext(guild, guild.channels[CHANNEL_BASE + g]))
+    latencies = []
+    for i in range(options.assigns):
+        ctx = contexts[i % len(contexts)]
+        started = time.perf_counter()
+        await callback(ctx, FakeRole(ROLE_BASE + i), None, "{user_mention} got the {role_name} role!! 🎉", False)
+        latencies.append(time.perf_counter() - started)
+    promotion.flush_task.cancel()
+    return latencies, options.assigns
+
+# save_mappings for a batch of changed servers, then the flush that writes them.
+async def save_flushes(options, directory: str):
+    promotion.SAVE_DELAY = 3600
+    promotion.assignments.load(synthetic_mappings(options.dirty * options.rounds, 10))
+    latencies = []
+    for round_number in range(options.rounds):
+        started = time.perf_counter()
+        for g in range(options.dirty):
+            promotion.save_mappings(GUILD_BASE + round_number * options.dirty + g)
+        await promotion.flush_mappings()
+        latencies.append(time.perf_counter() - started)
+    promotion.flush_task.cancel()
+    return latencies, options.dirty * options.rounds
+
+# Write one json file per server, to load from.
+def write_guild_files(options, directory: str):
+    for server, roles in synthetic_mappings(options.guilds, options.roles).items():
+        with open(f"{directory}/{server}.json", "w", encoding="utf-8") as f:
+            json.dump({server: roles}, f, indent=4)
+
+# load_mappings from a folder of json files, reading every file each time.
+async def load_cold(options, directory: str):
+    write_guild_files(options, directory)
+    latencies = []
+    for _ in range(options.loads):
+        started = time.perf_counter()
+        promotion.load_mappings()
+        latencies.append(time.perf_counter() - started)
+    return latencies, options.loads
+
+# load_mappings with an up to date snapshot, like a restart after nothing changed.
+async def load_snapshot(options, directory: str):
+    write_guild_files(options, directory)
+    promotion.storage = promotion.JsonStorage(f"{directory}/", snapshot=True)
+    # The first load builds the snapshot.
+    promotion.load_mappings()
+    latencies = []
+    for _ in range(options.loads):
+        started = time.perf_counter()
+        promotion.load_mappings()
+        latencies.append(time.perf_counter() - started)
+    return latencies, options.loads
+
+WORKLOADS = {
+    "member_update_storm": member_update_storm,
+    "assign": assign_commands,
+    "save_mappings": save_flushes,
+    "load_mappings_cold": load_cold,
+    "load_mappings_snapshot": load_snapshot,
+}
+
+# Run a workload once for timing and, unless turned off, once more under tracemalloc for its peak memory.
+# Tracing slows everything down, so it never runs during the timing pass.
+def run_workload(name: str, options) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        reset_bot(directory)
+        started = time.perf_counter()
+        latencies, operations = asyncio.run(WORKLOADS[name](options, directory))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    # Throughput only counts the time spent in the bot's code, not building the fake objects.
+    result = {"operations": operations,
+              "seconds": round(elapsed, 3),
+              "throughput": round(operations / sum(latencies), 1),
+              "p50_us": round(promotion.percentile(latencies, 50) * 1e6, 2),
+              "p99_us": round(promotion.percentile(latencies, 99) * 1e6, 2)}
+    if options.memory:
+        with tempfile.TemporaryDirectory() as directory:
+            reset_bot(directory)
+            tracemalloc.start()
+            asyncio.run(WORKLOADS[name](options, directory))
+            result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+    return result
+
+# Member data like Discord sends it, for one member of the synthetic large server.
+def member_payload(member_id: int, role_ids: list) -> dict:
+    return {"user": {"id": str(member_id), "username": f"user{member_id}", "discriminator": "0", "avatar": None, "global_name": f"User {member_id}"},
+            "roles": [str(role_id) for role_id in role_ids], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0}
+
+# Memory used to keep one large server's members: py-cord's full member cache, the way the bot runs normally,
+# against the role cache of low memory mode, which only keeps the watched roles of members who have any.
+def benchmark_member_cache(options) -> dict:
+    rng = random.Random(1)
+    role_ids = list(range(ROLE_BASE, ROLE_BASE + options.guild_roles))
+    watched = set(role_ids[:options.watched])
+    memberships = [rng.sample(role_ids, options.member_roles) for _ in range(options.members)]
+
+    # py-cord's own objects, cached the same way chunking caches them.
+    intents = discord.Intents.default()
+    intents.members = True
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None, loop=None,
+                            intents=intents, member_cache_flags=discord.MemberCacheFlags.all())
+    role_payloads = [{"id": str(role_id), "name": f"Role {role_id}", "permissions": "0", "position": i, "color": 0,
+                      "colors": {"primary_color": 0, "secondary_color": None, "tertiary_color": None},
+                      "hoist": False, "managed": False, "mentionable": False} for i, role_id in enumerate(role_ids)]
+    guild = discord.Guild(data={"id": str(GUILD_BASE), "name": "Large server", "roles": role_payloads,
+                                "emojis": [], "features": [], "member_count": 0}, state=state)
+    tracemalloc.start()
+    for i, member_roles in enumerate(memberships):
+        guild._add_member(discord.Member(data=member_payload(GUILD_BASE + i, member_roles), guild=guild, state=state))
+    full = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del guild, state
+
+    role_cache = promotion.RoleCache()
+    tracemalloc.start()
+    for i, member_roles in enumerate(memberships):
+        role_cache.update(GUILD_BASE, GUILD_BASE + i, member_roles, watched)
+    compact = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    result = {"members": options.members, "full_cache_mb": round(full / 2 ** 20, 1), "role_cache_mb": round(compact / 2 ** 20, 2),
+              "members_in_role_cache": len(role_cache.members[GUILD_BASE])}
+    print(f"Member memory for one server with {options.members} members, {options.guild_roles} roles, "
+          f"{options.member_roles} roles per member and {options.watched} watched roles")
+    print(f"py-cord member cache: {result['full_cache_mb']:.1f} MB, low memory role cache: {result['role_cache_mb']:.2f} MB "
+          f"({result['members_in_role_cache']} members kept, {full / max(compact, 1):.0f}x smaller)")
+    print()
+    return result
+
+# Time a function and return the best time per call in microseconds.
+def best_time(func, number=100_000):
+    return min(repeat(func, number=number, repeat=5)) / number * 1_000_000
+
+def benchmark_templates():
+    member = FakeMember(FakeGuild(1, [], []), 123456789012345678, [])
+    role = FakeRole(876543210987654321)
+    print("Message rendering (µs per message, lower is better)")
+    print(f"{'message':<14}{'re.sub':>10}{'template':>10}{'speedup':>10}")
+    for name, message in MESSAGES.items():
+        template = promotion.MessageTemplate(message)
+        assert template.render(member, role) == render_with_re_sub(message, member, role)
+        old = best_time(lambda: render_with_re_sub(message, member, role))
+        new = best_time(lambda: template.render(member, role))
+        print(f"{name:<14}{old:>10.3f}{new:>10.3f}{old / new:>9.1f}x")
+    print()
+
+# The commit being benchmarked, so saved results say where they came from.
+def current_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results: dict, baseline: dict | None):
+    print(f"{'workload':<24}{'ops':>9}{'ops/s':>12}{'p50 µs':>10}{'p99 µs':>10}{'peak MB':>9}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['operations']:>9}{result['throughput']:>12.1f}{result['p50_us']:>10.2f}{result['p99_us']:>10.2f}"
+              f"{result.get('peak_mb', float('nan')):>9.1f}")
+        previous = (baseline or {}).get("workloads", {}).get(name)
+        if previous:
+            # Positive means better: more throughput, less latency and memory.
+            changes = [f"{key} {(result[key] / previous[key] - 1) * 100 * (1 if key == 'throughput' else -1):+.1f}%"
+                       for key in ("throughput", "p50_us", "p99_us", "peak_mb") if previous.get(key) and key in result]
+            print(f"{'':<24}vs {baseline.get('commit') or 'baseline'}: {', '.join(changes)}")
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Promotion!!")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help=f"Which workloads to run, out of templates, member_cache, {', '.join(WORKLOADS)}. Defaults to all of them.")
+    parser.add_argument("--guilds", type=int, default=10_000, help="Servers with assignments.")
+    parser.add_argument("--roles", type=int, default=100, help="Watched roles per server.")
+    parser.add_argument("--updates", type=int, default=100_000, help="Member updates in the storm.")
+    parser.add_argument("--assigns", type=int, default=10_000, help="/assign commands to run.")
+    parser.add_argument("--dirty", type=int, default=100, help="Changed servers per save flush.")
+    parser.add_argument("--rounds", type=int, default=20, help="Save flushes to run.")
+    parser.add_argument("--loads", type=int, default=5, help="Times to load the assignments.")
+    parser.add_argument("--members", type=int, default=100_000, help="Members in the large server of the member cache benchmark.")
+    parser.add_argument("--guild-roles", type=int, default=200, help="Roles in that server.")
+    parser.add_argument("--member-roles", type=int, default=5, help="Roles every member has.")
+    parser.add_argument("--watched", type=int, default=5, help="Roles in that server with assignments.")
+    parser.add_argument("--quick", action="store_true", help="A tenth of the servers, updates and commands, for a fast check.")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Skip the peak memory pass.")
+    parser.add_argument("--save", metavar="FILE", help="Save the results as json.")
+    parser.add_argument("--compare", metavar="FILE", help="Compare against results saved with --save.")
+    options = parser.parse_args()
+    for name in options.workloads:
+        if name not in ("templates", "member_cache") and name not in WORKLOADS:
+            parser.error(f"unknown workload: {name}")
+    if options.quick:
+        options.guilds //= 10
+        options.updates //= 10
+        options.assigns //= 10
+        options.members //= 10
+    return options
+
+if __name__ == "__main__":
+    options = parse_options()
+    # Only real problems should show up between the results.
+    promotion.log.setLevel(logging.WARNING)
+    workloads = options.workloads or ["templates", "member_cache"] + list(WORKLOADS)
+    if "templates" in workloads:
+        benchmark_templates()
+    member_cache = benchmark_member_cache(options) if "member_cache" in workloads else None
+    results = {name: run_workload(name, options) for name in workloads if name in WORKLOADS}
+    baseline = None
+    if options.compare:
+        with open(options.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    if results:
+        print_results(results, baseline)
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as f:
+            json.dump({"commit": current_commit(), "options": vars(options), "workloads": results, "member_cache": member_cache}, f, indent=4)
@@ -11,10 +11,24 @@ r"""
 import discord
 from discord.ext import commands
 from discord.commands import Option
+import asyncio
+import atexit
+import copy
 import json
+import logging
+import logging.handlers
+import queue
+import pickle
+import random
 import re
-from sys import stderr, exception
-from os import listdir, getenv
+import sqlite3
+import subprocess
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from sys import stderr, argv, executable, exit
+from os import scandir, getenv, replace, remove, fsync, path, environ
 import dotenv
 from datetime import datetime
 
@@ -23,50 +37,917 @@ from datetime import datetime
 dotenv.load_dotenv()
 bot_token = str(getenv("DISCORD_TOKEN"))
 
+# How much gets logged: DEBUG, INFO, WARNING or ERROR. DEBUG logs every member update, so it's off by default.
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO").upper()
+# "text" for the usual human readable lines, "json" for one json object per line.
+LOG_FORMAT = getenv("LOG_FORMAT", "text")
+
+# Log lines look like they always have: "12:34:56:789012 -- Message".
+# Warnings and errors get their level in front, "12:34:56:789012 -- WARNING -- Message", so they stand out.
+class TextFormatter(logging.Formatter):
+    def formatTime(self, record, datefmt=None):
+        return datetime.fromtimestamp(record.created).strftime('%H:%M:%S:%f')
+
+    def __init__(self):
+        super().__init__("%(asctime)s -- %(message)s")
+        self.leveled = logging.Formatter("%(asctime)s -- %(levelname)s -- %(message)s")
+        self.leveled.formatTime = self.formatTime
+
+    def format(self, record):
+        if record.levelno >= logging.WARNING:
+            return self.leveled.format(record)
+        return super().format(record)
+
+# One json object per line, with any extra fields passed as extra={"fields": {...}}.
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(), "level": record.levelname, "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+# Hands log records to the logging thread with as little work as possible on the event loop.
+# The message and traceback are turned into text right away, since the objects they refer to might change,
+# but timestamps and the final line are formatted by the logging thread.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# Send every log record through a queue to a thread that does the actual writing to stderr.
+def setup_logging() -> logging.handlers.QueueListener:
+    handler = logging.StreamHandler(stderr)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("promotion")
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    # Write whatever is still queued when the bot exits.
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+log = logging.getLogger("promotion")
+
 # The intents the bot uses. Default + members for checking role updates.
 intents = discord.Intents.default()
 intents.members = True
 
+# Low memory mode doesn't keep every member of every server in memory, only the watched roles of members who have any.
+# Role updates are then read straight from Discord's member update events instead of from cached members.
+LOW_MEMORY = getenv("LOW_MEMORY", "false").lower() == "true"
+# Don't load every member on startup and don't cache any of them.
+cache_options = {"member_cache_flags": discord.MemberCacheFlags.none(), "chunk_guilds_at_startup": False} if LOW_MEMORY else {}
+
+# Total number of shards across every worker process. Leave it out to let Discord decide, or to not shard at all.
+SHARD_COUNT = int(getenv("SHARD_COUNT", 0)) or None
+# Which of those shards this process runs, like "0,1,2". Leave it out to run all of them.
+SHARD_IDS = [int(shard_id) for shard_id in getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+# Whether to run the bot sharded. Setting SHARD_COUNT turns it on too.
+SHARDED = getenv("SHARDED", "false").lower() == "true" or SHARD_COUNT is not None
+# (shard count, shard IDs) when this process only runs some of the shards, so it only loads those servers' assignments.
+OWNED_SHARDS = (SHARD_COUNT, SHARD_IDS) if SHARD_COUNT and SHARD_IDS else None
+
+# The shard a server belongs to, the same way Discord decides it.
+def shard_of(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+# Sharded bots run every shard they own in this one process.
+BaseBot = discord.AutoShardedBot if SHARDED else discord.Bot
+
+# The bot, but it writes any unsaved assignments before shutting down.
+class PromotionBot(BaseBot):
+    async def close(self):
+        coalescer.flush_all()
+        await dispatcher.drain(timeout=10)
+        await flush_mappings()
+        await super().close()
+
 # Create bot object thing and make sure it uses the intents above.
-bot = discord.Bot(intents=intents)
+if SHARDED:
+    bot = PromotionBot(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **cache_options)
+else:
+    bot = PromotionBot(intents=intents, **cache_options)
+
+# Counts events, both in total and per second over the last minute.
+class RateMeter:
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.total = 0
+        # [second, events in that second], oldest first.
+        self.buckets = deque()
+
+    def tick(self):
+        self.total += 1
+        second = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([second, 1])
+            while self.buckets[0][0] <= second - self.window:
+                self.buckets.popleft()
 
-# Initialize global variable for last message to avoid spam.
-last_message = ""
+    # Events per second over the window.
+    def rate(self) -> float:
+        cutoff = int(time.monotonic()) - self.window
+        return sum(count for second, count in self.buckets if second > cutoff) / self.window
+
+# Every member update the bot received, and the ones that actually added a watched role.
+events_seen = RateMeter()
+events_matched = RateMeter()
+# How long the most recent matching member updates spent on each step, in seconds.
+# The send step is measured by the dispatcher, from queueing to Discord accepting the message.
+spans = {"filter": deque(maxlen=1000), "render": deque(maxlen=1000)}
 
 # What it does on startup.
 @bot.event
 async def on_ready():
-    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- {bot.user} is running!\n")
-    stderr.write("----------====================----------\n")
+    log.info(f"{bot.user} is running!")
 
-# Load mappings from the json files.
-# This is to save data if the bot restarts.
-def load_mappings():
-    try:
+# Every token that can be used in a message, and how to get its value from the member and the role that was added.
+TOKENS = {
+    "user_mention": lambda member, role: member.mention,
+    "user_tag": lambda member, role: member.name,
+    "user_name": lambda member, role: member.display_name,
+    "user_id": lambda member, role: str(member.id),
+    "role_mention": lambda member, role: role.mention,
+    "role_name": lambda member, role: str(role),
+    "role_id": lambda member, role: str(role.id),
+}
+# The tokens that are about the member. These turn into lists when several promotions are combined.
+USER_TOKENS = {TOKENS[token] for token in ("user_mention", "user_tag", "user_name", "user_id")}
+# Matches any of the tokens above. Only used when compiling a message, never when sending one.
+TOKEN_PATTERN = re.compile("(" + "|".join(re.escape("{" + token + "}") for token in TOKENS) + ")")
+
+# An assigned message, split into plain text and tokens once so it can be filled in with a single join.
+class MessageTemplate:
+    __slots__ = ("source", "parts", "static", "coalesce")
+
+    def __init__(self, source: str, coalesce: bool = False):
+        self.source = source
+        # Whether promotions that happen close together get combined into one message.
+        self.coalesce = coalesce
+        # split() puts the plain text on even positions and the matched tokens on odd positions.
+        self.parts = tuple(piece if i % 2 == 0 else TOKENS[piece[1:-1]]
+                           for i, piece in enumerate(TOKEN_PATTERN.split(source)) if piece)
+        # Messages without any tokens never need to be rendered.
+        self.static = all(type(part) is str for part in self.parts)
+
+    def render(self, member, role) -> str:
+        if self.static:
+            return self.source
+        return "".join(part if type(part) is str else part(member, role) for part in self.parts)
+
+    # Render one message for a group of members, split into as many messages as it takes to stay under the character limit.
+    def render_many(self, members: list, role) -> list:
+        # Every member adds their own values plus a ", " for every user token in the message.
+        separators = 2 * sum(1 for part in self.parts if part in USER_TOKENS)
+        base = len(self.render(MemberGroup([]), role))
+        messages = []
+        start = 0
+        while start < len(members):
+            # Add members while the estimated length fits, then drop the last ones until the real message does.
+            # A message always gets at least one member, so nothing gets stuck. If one member is already too long, the message gets cut off.
+            length, end = base, start
+            while end < len(members):
+                length += len(self.render(members[end], role)) - base + separators
+                if length > MESSAGE_LIMIT and end > start:
+                    break
+                end += 1
+            message = self.render(MemberGroup(members[start:end]), role)
+            while len(message) > MESSAGE_LIMIT and end - start > 1:
+                end -= 1
+                message = self.render(MemberGroup(members[start:end]), role)
+            messages.append(message[:MESSAGE_LIMIT])
+            start = end
+        return messages
+
+# Discord doesn't allow messages longer than this.
+MESSAGE_LIMIT = 2000
+
+# Stands in for a member when rendering one message for several members.
+# Every user token turns into a list like "@a, @b and @c".
+class MemberGroup:
+    __slots__ = ("members",)
+
+    def __init__(self, members: list):
+        self.members = members
+
+    def _join(self, values: list) -> str:
+        if len(values) < 2:
+            return "".join(values)
+        return f"{', '.join(values[:-1])} and {values[-1]}"
+
+    @property
+    def mention(self) -> str:
+        return self._join([member.mention for member in self.members])
+
+    @property
+    def name(self) -> str:
+        return self._join([member.name for member in self.members])
+
+    @property
+    def display_name(self) -> str:
+        return self._join([member.display_name for member in self.members])
+
+    @property
+    def id(self) -> str:
+        return self._join([str(member.id) for member in self.members])
+
+# Every assignment, kept in memory with integer IDs instead of the strings the json files use.
+# Looking something up never needs a str() or int() call, and the reverse indexes make removals cheap.
+# Loaded servers stay in the json format until something needs them, so startup doesn't compile every message of every server.
+class AssignmentIndex:
+    __slots__ = ("guilds", "channel_roles", "watched", "pending", "version", "versions")
+
+    def __init__(self):
+        # Goes up with every change. Server -> the version it last changed at, so anything built from a server's
+        # assignments can tell whether it's still up to date.
+        self.version = 0
+        self.versions = {}
+        # Server -> its assignments in the json format, for servers that haven't been needed yet.
+        self.pending = {}
+        # Server -> role -> channel -> tuple of message templates.
+        self.guilds = {}
+        # Server -> channel -> roles with an assignment in that channel.
+        self.channel_roles = {}
+        # Server -> every role with an assignment. Checked on every member update.
+        self.watched = {}
+
+    def __contains__(self, guild_id: int) -> bool:
+        self._ensure(guild_id)
+        return guild_id in self.guilds
+
+    # The assignments of a server, or an empty dict if it has none.
+    def roles(self, guild_id: int) -> dict:
+        self._ensure(guild_id)
+        return self.guilds.get(guild_id, {})
+
+    # The roles a server has assignments for, or None if it has none.
+    def watched_roles(self, guild_id: int) -> set | None:
+        self._ensure(guild_id)
+        return self.watched.get(guild_id)
+
+    def _changed(self, guild_id: int):
+        self.version += 1
+        self.versions[guild_id] = self.version
+
+    # Build the index for a server the first time it's needed.
+    # This runs inside event handlers, so broken entries get logged and left out instead of raising there.
+    def _ensure(self, guild_id: int):
+        roles = self.pending.pop(guild_id, None)
+        if roles is None:
+            return
+        entries, skipped = self._compile(roles)
+        if skipped:
+            log.warning(f"Skipped {len(skipped)} broken assignment(s) of server {guild_id}, they'll be gone the next time it's saved: {'; '.join(skipped)}",
+                        extra={"fields": {"guild_id": guild_id, "skipped": skipped}})
+        for role_id, channel_id, message, coalesce in entries:
+            self.add(guild_id, role_id, channel_id, message, coalesce)
+
+    # Turn a server's assignments in the json format into (role, channel, message, coalesce).
+    # Returns those and a description of everything that had to be skipped, so one bad entry never costs the rest.
+    @staticmethod
+    def _compile(roles) -> tuple:
+        entries, skipped = [], []
+        if not isinstance(roles, dict):
+            return entries, [f"not a role -> channel -> messages object: {roles!r}"]
+        for role, channels in roles.items():
+            if not (str(role).isascii() and str(role).isdigit() and isinstance(channels, dict)):
+                skipped.append(f"role {role!r}")
+                continue
+            for channel, messages in channels.items():
+                if not (str(channel).isascii() and str(channel).isdigit() and isinstance(messages, list)):
+                    skipped.append(f"role {role}, channel {channel!r}")
+                    continue
+                for message in messages:
+                    if isinstance(message, dict):
+                        text, coalesce = message.get("message"), bool(message.get("coalesce", False))
+                    else:
+                        text, coalesce = message, False
+                    if not isinstance(text, str):
+                        skipped.append(f"role {role}, channel {channel}, message {message!r}")
+                        continue
+                    entries.append((int(role), int(channel), text, coalesce))
+        return entries, skipped
+
+    def add(self, guild_id: int, role_id: int, channel_id: int, message: str, coalesce: bool = False):
+        self._ensure(guild_id)
+        channels = self.guilds.setdefault(guild_id, {}).setdefault(role_id, {})
+        channels[channel_id] = channels.get(channel_id, ()) + (MessageTemplate(message, coalesce),)
+        self.channel_roles.setdefault(guild_id, {}).setdefault(channel_id, set()).add(role_id)
+        self.watched.setdefault(guild_id, set()).add(role_id)
+        self._changed(guild_id)
+
+    # All the remove methods return whether there was anything to remove.
+    def remove_guild(self, guild_id: int) -> bool:
+        self._ensure(guild_id)
+        self._changed(guild_id)
+        self.channel_roles.pop(guild_id, None)
+        self.watched.pop(guild_id, None)
+        return self.guilds.pop(guild_id, None) is not None
+
+    def remove_role(self, guild_id: int, role_id: int) -> bool:
+        channels = self.roles(guild_id).get(role_id)
+        if channels is None:
+            return False
+        for channel_id in list(channels):
+            self._unlink(guild_id, role_id, channel_id)
+        return True
+
+    def remove_role_channel(self, guild_id: int, role_id: int, channel_id: int) -> bool:
+        if channel_id not in self.roles(guild_id).get(role_id, {}):
+            return False
+        self._unlink(guild_id, role_id, channel_id)
+        return True
+
+    def remove_channel(self, guild_id: int, channel_id: int) -> bool:
+        self._ensure(guild_id)
+        role_ids = self.channel_roles.get(guild_id, {}).get(channel_id)
+        if not role_ids:
+            return False
+        for role_id in list(role_ids):
+            self._unlink(guild_id, role_id, channel_id)
+        return True
+
+    def remove_message(self, guild_id: int, role_id: int, channel_id: int, message: str) -> bool:
+        templates = self.roles(guild_id).get(role_id, {}).get(channel_id, ())
+        for i, template in enumerate(templates):
+            if template.source == message:
+                # If the message is the only one there, remove the entire channel.
+                if len(templates) == 1:
+                    self._unlink(guild_id, role_id, channel_id)
+                else:
+                    self.guilds[guild_id][role_id][channel_id] = templates[:i] + templates[i + 1:]
+                    self._changed(guild_id)
+                return True
+        return False
+
+    # Remove a channel from a role and clean up everything that's left empty because of it.
+    def _unlink(self, guild_id: int, role_id: int, channel_id: int):
+        self._changed(guild_id)
+        roles = self.guilds[guild_id]
+        roles[role_id].pop(channel_id)
+        channel_roles = self.channel_roles[guild_id]
+        channel_roles[channel_id].discard(role_id)
+        if not channel_roles[channel_id]:
+            del channel_roles[channel_id]
+        if not roles[role_id]:
+            del roles[role_id]
+            self.watched[guild_id].discard(role_id)
+        if not roles:
+            self.remove_guild(guild_id)
+
+    # Add everything from the json format ({server: {role: {channel: [messages]}}}, all IDs as strings).
+    # A message is either just its text, or {"message": text, "coalesce": true} for combined announcements.
+    def load(self, mappings: dict):
+        for server, roles in mappings.items():
+            self.pending[int(server)] = roles
+            self._ensure(int(server))
+
+    # Keep servers in the json format until they're needed.
+    def load_lazily(self, mappings: dict):
+        for server, roles in mappings.items():
+            self.pending[int(server)] = roles
+
+    # A server's assignments in the json format, or None if it has none.
+    def dump(self, guild_id: int) -> dict | None:
+        self._ensure(guild_id)
+        roles = self.guilds.get(guild_id)
+        if roles is None:
+            return None
+        return {str(guild_id): {str(role): {str(channel): [{"message": template.source, "coalesce": True} if template.coalesce else template.source
+                                                           for template in templates]
+                                            for channel, templates in channels.items()}
+                                for role, channels in roles.items()}}
+
+# How many messages can be sent at the same time, across every channel.
+MAX_CONCURRENT_SENDS = int(getenv("MAX_CONCURRENT_SENDS", 10))
+# How many times a message gets retried after Discord refuses it.
+MAX_SEND_RETRIES = 5
+# Backoff between retries: starts at BACKOFF_BASE seconds, doubles every time, never longer than BACKOFF_MAX.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Get the nearest-rank percentile of an already sorted list.
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+# Sends announcements in the background so member updates never wait for Discord.
+# Every channel gets its own queue and worker, so a slow or rate limited channel only holds up its own messages,
+# and a semaphore caps how many messages are being sent at once across all of them.
+class Dispatcher:
+    def __init__(self, concurrency: int, retries: int):
+        # Channel ID -> queue of (channel, message, time it was queued).
+        self.queues = {}
+        # Channel ID -> the task sending that channel's queue.
+        self.workers = {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        # Loop time until which Discord told us to stop sending anything (global rate limit).
+        self.global_block_until = 0.0
+        # Seconds between queueing and sending the most recent messages.
+        self.latencies = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    # Queue a message and return right away.
+    def enqueue(self, channel, message: str):
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = asyncio.Queue()
+        queue.put_nowait((channel, message, asyncio.get_running_loop().time()))
+        if channel.id not in self.workers:
+            self.workers[channel.id] = asyncio.create_task(self._worker(channel.id, queue))
+
+    # Send a channel's messages in order until its queue is empty, then clean up.
+    # There's no await between the last empty() check and the cleanup, so nothing can be queued in between.
+    async def _worker(self, channel_id: int, queue: asyncio.Queue):
+        try:
+            while not queue.empty():
+                channel, message, queued_at = queue.get_nowait()
+                await self._send(channel, message)
+                self.latencies.append(asyncio.get_running_loop().time() - queued_at)
+        finally:
+            del self.workers[channel_id]
+            del self.queues[channel_id]
+
+    # Send one message, retrying rate limits and server errors with exponential backoff.
+    async def _send(self, channel, message: str):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            # Wait out a global rate limit before even trying.
+            if self.global_block_until > loop.time():
+                await asyncio.sleep(self.global_block_until - loop.time())
+            try:
+                async with self.semaphore:
+                    await channel.send(message)
+                self.sent += 1
+                return
+            except discord.HTTPException as e:
+                # Only rate limits and Discord's own errors are worth retrying. Missing permissions won't fix themselves.
+                if attempt == self.retries or not (e.status == 429 or e.status >= 500):
+                    self.failed += 1
+                    log.exception(f"Error sending message to {channel}.")
+                    return
+                delay = self._retry_after(e)
+                if delay is None:
+                    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.5)
+                # A global rate limit stops every channel, not just this one.
+                if e.status == 429 and getattr(e.response, "headers", {}).get("X-RateLimit-Global"):
+                    self.global_block_until = loop.time() + delay
+                self.retried += 1
+                log.warning(f"Sending to {channel} failed with {e.status}, retrying in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+            except Exception:
+                self.failed += 1
+                log.exception(f"Error sending message to {channel}.")
+                return
+
+    # How long Discord asked us to wait, if it did.
+    @staticmethod
+    def _retry_after(e: discord.HTTPException) -> float | None:
+        try:
+            return float(e.response.headers["Retry-After"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    # Wait for every queued message to be sent, or for the timeout. Used on shutdown.
+    async def drain(self, timeout: float):
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {"queued": sum(queue.qsize() for queue in self.queues.values()),
+                "busiest_queue": max((queue.qsize() for queue in self.queues.values()), default=0),
+                "active_channels": len(self.workers),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "latency_p50": percentile(latencies, 50),
+                "latency_p99": percentile(latencies, 99)}
+
+# Instantiate the dispatcher every announcement goes through.
+dispatcher = Dispatcher(MAX_CONCURRENT_SENDS, MAX_SEND_RETRIES)
+
+# How many seconds an announcement is remembered for, so repeats within that time get skipped.
+DEDUP_TTL = float(getenv("DEDUP_TTL", 60))
+# How many announcements are remembered at most. The oldest ones get forgotten first.
+DEDUP_MAX_SIZE = int(getenv("DEDUP_MAX_SIZE", 10000))
+
+# Remembers recently sent announcements to avoid spam, like the same role being toggled or a replayed gateway event.
+# Entries are kept in the order they were added, and since they all live equally long that's also the order they expire in,
+# so evicting is always just popping from the front.
+class DedupCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Key -> time it expires at.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Whether the key was seen within the TTL. If it wasn't, remember it from now on.
+    def seen(self, key) -> bool:
+        now = time.monotonic()
+        expires = self.entries.get(key)
+        if expires is not None and expires > now:
+            self.hits += 1
+            return True
+        self.misses += 1
+        # An expired entry gets added again at the back, where new entries belong.
+        if expires is not None:
+            del self.entries[key]
+        self.entries[key] = now + self.ttl
+        # Forget everything that's expired or doesn't fit anymore.
+        while self.entries and (len(self.entries) > self.max_size or next(iter(self.entries.values())) <= now):
+            self.entries.popitem(last=False)
+        return False
+
+# Instantiate the cache that skips repeat announcements.
+dedup = DedupCache(DEDUP_TTL, DEDUP_MAX_SIZE)
+
+# How many seconds promotions get collected for before being sent as one message, for assignments that combine them.
+COALESCE_WINDOW = float(getenv("COALESCE_WINDOW", 5))
+
+# Collects promotions for the same channel, role and message for a short while, then sends them as one combined message.
+# During a mass role grant this turns hundreds of messages into a handful.
+class Coalescer:
+    def __init__(self, window: float):
+        self.window = window
+        # (channel ID, role ID, template) -> (channel, role, members waiting to be announced).
+        self.pending = {}
+        # Same keys -> the timer that sends them.
+        self.timers = {}
+
+    def add(self, channel, role, template: MessageTemplate, member):
+        key = (channel.id, role.id, template)
+        if key not in self.pending:
+            self.pending[key] = (channel, role, [])
+            self.timers[key] = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+        self.pending[key][2].append(member)
+
+    # Render the collected promotions and hand them to the dispatcher.
+    def flush(self, key):
+        self.timers.pop(key).cancel()
+        channel, role, members = self.pending.pop(key)
+        template = key[2]
+        log.info(f"Sending {len(members)} combined promotion(s) to {channel}.")
+        for message in template.render_many(members, role):
+            dispatcher.enqueue(channel, message)
+
+    # Send everything that's still waiting. Used on shutdown.
+    def flush_all(self):
+        for key in list(self.pending):
+            self.flush(key)
+
+# Instantiate the coalescer for assignments that combine their messages.
+coalescer = Coalescer(COALESCE_WINDOW)
+
+# How many servers get their members read at the same time in low memory mode.
+SEED_CONCURRENCY = 2
+
+# For low memory mode: the watched roles every member has, for members that have at least one, and nothing else.
+# Member update events only say which roles a member has now, so this is what tells which ones are new.
+class RoleCache:
+    def __init__(self):
+        # Server -> member ID -> the watched roles they have.
+        self.members = {}
+        # Role sets are shared between every member that has the same ones, most members with watched roles have just one or two.
+        self.role_sets = {}
+        # Servers whose members were read since their watched roles last changed.
+        # Their updates can't be trusted before that, a member who already had a role would look like they just got it.
+        self.ready = set()
+        self.seeding = {}
+        self.semaphore = asyncio.Semaphore(SEED_CONCURRENCY)
+
+    # Store the watched roles a member has now and return the ones they didn't have before.
+    def update(self, guild_id: int, member_id: int, role_ids, watched: set) -> set:
+        held = watched.intersection(role_ids)
+        members = self.members.setdefault(guild_id, {})
+        previous = members.get(member_id, frozenset())
+        if held:
+            held = frozenset(held)
+            members[member_id] = self.role_sets.setdefault(held, held)
+        else:
+            members.pop(member_id, None)
+        return held - previous
+
+    def remove(self, guild_id: int, member_id: int):
+        self.members.get(guild_id, {}).pop(member_id, None)
+
+    # Read every member of a server once, in the background, and keep only their watched roles.
+    # Used when the server becomes available, and again whenever it starts watching a new role.
+    def seed(self, guild):
+        self.ready.discard(guild.id)
+        if guild.id in self.seeding:
+            self.seeding[guild.id].cancel()
+        self.seeding[guild.id] = asyncio.create_task(self._seed(guild))
+
+    async def _seed(self, guild):
+        try:
+            async with self.semaphore:
+                started = time.perf_counter()
+                watched = assignments.watched_roles(guild.id) or set()
+                self.members[guild.id] = {}
+                count = 0
+                # fetch_members pages through the server without adding anyone to py-cord's cache.
+                async for member in guild.fetch_members(limit=None):
+                    self.update(guild.id, member.id, member._roles, watched)
+                    count += 1
+                self.ready.add(guild.id)
+                log.info(f"Read {count} member(s) of {guild.name} in {time.perf_counter() - started:.1f}s, "
+                         f"{len(self.members[guild.id])} have watched roles.")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f"Error reading the members of {guild.name}.")
+        finally:
+            if self.seeding.get(guild.id) is asyncio.current_task():
+                del self.seeding[guild.id]
+
+# Instantiate the role cache used in low memory mode.
+role_cache = RoleCache()
+
+# Where assignments are stored: "json" for one json file per server in assignments/ (the default), or "sqlite" for a database.
+STORAGE = getenv("STORAGE", "json")
+# The database file used when STORAGE is "sqlite".
+SQLITE_PATH = getenv("SQLITE_PATH", "promotion.db")
+
+# Storage backends all do the same two things:
+# load() returns every assignment in the json format ({server: {role: {channel: [messages]}}}, all IDs as strings),
+# and write() takes {server ID: that server's assignments in the json format, or None if it has none left}
+# and returns the server IDs that couldn't be written. write() runs in a worker thread.
+
+# Whether to keep every json file in one snapshot file as well, so the next start only has to read the files that changed.
+USE_SNAPSHOT = getenv("SNAPSHOT", "false").lower() == "true"
+# How many json files are read at the same time on startup.
+LOAD_WORKERS = int(getenv("LOAD_WORKERS", 8))
+
+# Stores every server's assignments in its own json file.
+class JsonStorage:
+    def __init__(self, directory: str, snapshot: bool = False, workers: int = 8, shards: tuple | None = None):
+        self.directory = directory
+        self.workers = workers
+        # (shard count, shard IDs) to only load the servers on those shards. Every server has its own file,
+        # so processes running different shards never write to the same file.
+        self.shards = shards
+        # Every process running its own shards keeps its own snapshot.
+        suffix = f"-{'-'.join(map(str, shards[1]))}-of-{shards[0]}" if shards else ""
+        self.snapshot_path = f"{directory}snapshot{suffix}.pickle" if snapshot else None
+
+    def _owns(self, file_name: str) -> bool:
+        if self.shards is None:
+            return True
+        server = file_name.removesuffix(".json")
+        return server.isascii() and server.isdigit() and shard_of(int(server), self.shards[0]) in self.shards[1]
+
+    # Files are read in parallel, and a broken file is logged and skipped instead of stopping everything else from loading.
+    def load(self) -> dict:
+        started = time.perf_counter()
+        # File name -> (modification time, size), to tell whether the snapshot's copy is still up to date.
+        with scandir(self.directory) as entries:
+            files = {entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+                     for entry in entries if entry.name.endswith(".json") and self._owns(entry.name)}
+        listed = time.perf_counter()
+        cached = self._read_snapshot()
+        # Take every unchanged file from the snapshot and only read the rest.
+        loaded = {name: cached[name][1] for name, fingerprint in files.items()
+                  if name in cached and cached[name][0] == fingerprint and self._is_valid(cached[name][1])}
+        to_read = [name for name in files if name not in loaded]
+        snapshotted = time.perf_counter()
+        failed = 0
+        if to_read:
+            with ThreadPoolExecutor(self.workers) as pool:
+                for name, file in zip(to_read, pool.map(self._read_file, to_read)):
+                    if file is None:
+                        failed += 1
+                    else:
+                        loaded[name] = file
+        read = time.perf_counter()
+        # Rebuild the snapshot if anything changed since it was made. Files that still fail don't count, or a broken file would rebuild it on every start.
+        if self.snapshot_path and (len(to_read) > failed or set(cached) != set(loaded)):
+            self._write_snapshot({name: (files[name], file) for name, file in loaded.items()})
         mappings = {}
-        for file_name in listdir("assignments/"):
-            if file_name.endswith(".json"):
-                with open(f"assignments/{file_name}", "r", encoding="utf-8") as f:
-                    file = json.load(f)
-                    mappings.update(file)
-        # stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Loaded mappings.\n\n{mappings}\n\n")
+        for file in loaded.values():
+            mappings.update(file)
+        timings = {"files": len(files), "servers": len(mappings), "reused": len(files) - len(to_read), "read": len(to_read), "failed": failed,
+                   "listing_ms": round((listed - started) * 1000, 1), "snapshot_ms": round((snapshotted - listed) * 1000, 1),
+                   "reading_ms": round((read - snapshotted) * 1000, 1), "total_ms": round((time.perf_counter() - started) * 1000, 1)}
+        log.info(f"Loaded {timings['servers']} server(s) from {timings['files']} file(s) in {timings['total_ms']} ms: "
+                 f"listing {timings['listing_ms']} ms, snapshot {timings['snapshot_ms']} ms ({timings['reused']} file(s) reused), "
+                 f"reading {timings['reading_ms']} ms ({timings['read']} file(s), {failed} failed).", extra={"fields": timings})
         return mappings
-    except Exception as e:
-        stderr.write(f"\n{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR LOADING MAPPINGS!\n\n{e.with_traceback(exception().__traceback__)}\n\n")
 
-# Store mappings in the aforementioned json files, one for every server.
-def save_mappings():
+    # Read and parse one file. Returns None if it's broken.
+    def _read_file(self, file_name: str) -> dict | None:
+        try:
+            with open(f"{self.directory}{file_name}", "rb") as f:
+                file = json.loads(f.read())
+            # Valid json that isn't servers -> roles would break merging every other file, or loading them later.
+            if not self._is_valid(file):
+                raise ValueError("expected an object of server IDs -> objects")
+            return file
+        except Exception:
+            log.exception(f"Error loading {file_name}, skipping it.")
+            return None
+
+    # Whether a file is {server ID: {...}}. What's inside every server gets checked when it's built.
+    @staticmethod
+    def _is_valid(file) -> bool:
+        return isinstance(file, dict) and all(isinstance(server, str) and server.isascii() and server.isdigit() and isinstance(roles, dict)
+                                              for server, roles in file.items())
+
+    # The snapshot is {file name: ((modification time, size), file contents)}.
+    def _read_snapshot(self) -> dict:
+        if not self.snapshot_path or not path.exists(self.snapshot_path):
+            return {}
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            log.warning(f"Couldn't read the snapshot, reading every file instead. ({e})")
+            return {}
+
+    def _write_snapshot(self, snapshot: dict):
+        try:
+            with open(f"{self.snapshot_path}.tmp", "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            replace(f"{self.snapshot_path}.tmp", self.snapshot_path)
+        except Exception as e:
+            log.warning(f"Couldn't write the snapshot. ({e})")
+
+    # Every file is written to a temporary file first and then renamed over the old one, so a crash never leaves half a file behind.
+    def write(self, snapshot: dict) -> list:
+        failed = []
+        for server, data in snapshot.items():
+            file_path = f"{self.directory}{server}.json"
+            try:
+                if data is None:
+                    if path.exists(file_path):
+                        remove(file_path)
+                else:
+                    with open(f"{file_path}.tmp", "w", encoding="utf-8") as f:
+                        json.dump(data, f, indent=4)
+                        f.flush()
+                        fsync(f.fileno())
+                    replace(f"{file_path}.tmp", file_path)
+            except Exception:
+                failed.append(server)
+                log.exception(f"Error saving mappings for {server}.")
+        return failed
+
+# Stores every assignment as a row in an SQLite database.
+# WAL mode lets other processes read the database while the bot writes to it,
+# and a write only touches the rows of the servers that changed, all in one transaction.
+class SqliteStorage:
+    def __init__(self, file_path: str, shards: tuple | None = None):
+        # (shard count, shard IDs) to only load the servers on those shards.
+        # Several processes can share the database this way, each one only ever writing the rows of its own servers.
+        self.shards = shards
+        # Writes happen in worker threads, but never two at once (see flush_lock).
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS assignments (
+                                           guild_id INTEGER NOT NULL,
+                                           role_id INTEGER NOT NULL,
+                                           channel_id INTEGER NOT NULL,
+                                           position INTEGER NOT NULL,
+                                           message TEXT NOT NULL,
+                                           combine INTEGER NOT NULL DEFAULT 0,
+                                           PRIMARY KEY (guild_id, role_id, channel_id, position))""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS assignments_by_channel ON assignments (guild_id, channel_id)")
+
+    # Every server is written in one go in the same order as the json format, so rowid keeps the order roles, channels and messages were added in.
+    def load(self) -> dict:
+        mappings = {}
+        if self.shards is None:
+            rows = self.connection.execute("SELECT guild_id, role_id, channel_id, message, combine FROM assignments "
+                                           "ORDER BY guild_id, rowid")
+        else:
+            shard_count, shard_ids = self.shards
+            rows = self.connection.execute("SELECT guild_id, role_id, channel_id, message, combine FROM assignments "
+                                           f"WHERE (guild_id >> 22) % ? IN ({', '.join('?' * len(shard_ids))}) "
+                                           "ORDER BY guild_id, rowid", (shard_count, *shard_ids))
+        for guild_id, role_id, channel_id, message, combine in rows:
+            messages = mappings.setdefault(str(guild_id), {}).setdefault(str(role_id), {}).setdefault(str(channel_id), [])
+            messages.append({"message": message, "coalesce": True} if combine else message)
+        return mappings
+
+    def write(self, snapshot: dict) -> list:
+        try:
+            with self.connection:
+                for server, data in snapshot.items():
+                    self.connection.execute("DELETE FROM assignments WHERE guild_id = ?", (server,))
+                    if data is not None:
+                        self.connection.executemany("INSERT INTO assignments VALUES (?, ?, ?, ?, ?, ?)", self._rows(data))
+            return []
+        except Exception:
+            log.exception("Error saving mappings.")
+            return list(snapshot)
+
+    # Turn a server's assignments in the json format into table rows.
+    @staticmethod
+    def _rows(data: dict):
+        for server, roles in data.items():
+            for role, channels in roles.items():
+                for channel, messages in channels.items():
+                    for position, message in enumerate(messages):
+                        if isinstance(message, dict):
+                            yield int(server), int(role), int(channel), position, message["message"], int(message.get("coalesce", False))
+                        else:
+                            yield int(server), int(role), int(channel), position, message, 0
+
+# Copy every assignment from the json files into the SQLite database, replacing what the database had for those servers.
+# Run it once with `python promotion.py migrate`. The json files are left alone.
+def migrate_json_to_sqlite():
+    mappings = JsonStorage("assignments/").load()
+    failed = SqliteStorage(SQLITE_PATH).write({int(server): {server: roles} for server, roles in mappings.items()})
+    log.info(f"Migrated {len(mappings) - len(failed)} server(s) from assignments/ to {SQLITE_PATH}.")
+
+# Instantiate the storage backend chosen in the .env file.
+if STORAGE == "sqlite":
+    storage = SqliteStorage(SQLITE_PATH, OWNED_SHARDS)
+else:
+    storage = JsonStorage("assignments/", USE_SNAPSHOT, LOAD_WORKERS, OWNED_SHARDS)
+
+# Load mappings from the storage backend.
+# This is to save data if the bot restarts.
+def load_mappings() -> dict:
     try:
-        for server, roles in role_channel_mapping.items():
-            with open(f"assignments/{server}.json", "w") as f:
-                json.dump({server: roles}, f, indent=4)
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Saved mappings.\n")
-    except Exception as e:
-        stderr.write(f"\n{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR SAVING MAPPINGS!\n\n{e.with_traceback(exception().__traceback__)}\n\n")
+        return storage.load()
+    except Exception:
+        log.exception("Error loading mappings.")
+        return {}
+
+# How many seconds to wait after a change before writing it, so a burst of edits ends up as one write.
+SAVE_DELAY = 2.0
+# Servers whose assignments changed since they were last written.
+dirty_guilds = set()
+# The scheduled write, if there is one.
+flush_task = None
+# Makes sure two writes never run at the same time and overwrite each other out of order.
+flush_lock = asyncio.Lock()
+
+# Store mappings in the storage backend.
+# Only marks the server as changed, the actual write happens a bit later, off the event loop.
+def save_mappings(guild_id):
+    global flush_task
+    dirty_guilds.add(guild_id)
+    if flush_task is None or flush_task.done():
+        flush_task = asyncio.get_running_loop().create_task(flush_mappings_later())
+
+# Wait for the burst of edits to end, then write everything that changed.
+async def flush_mappings_later():
+    await asyncio.sleep(SAVE_DELAY)
+    await flush_mappings()
 
-# Instantiate mappings dictionary.
-# Stores all the servers, roles, channels and messages.
-role_channel_mapping = load_mappings()
+# Write every changed server right now. Used by the timer and on shutdown.
+async def flush_mappings():
+    global flush_task
+    async with flush_lock:
+        snapshot = take_dirty_snapshot()
+        if not snapshot:
+            return
+        failed = await asyncio.to_thread(write_mappings, snapshot)
+        # Try the failed ones again next time.
+        dirty_guilds.update(failed)
+        log.info(f"Saved mappings for {len(snapshot) - len(failed)} server(s).")
+        # Servers edited during the write, or that failed, couldn't schedule a write of their own while this one ran, so schedule it for them.
+        if dirty_guilds:
+            flush_task = asyncio.get_running_loop().create_task(flush_mappings_later())
+
+# Copy every changed server while still on the event loop, so the writer thread never sees a half-edited dict.
+# None means the server has no assignments anymore and should be deleted from storage.
+def take_dirty_snapshot():
+    snapshot = {server: assignments.dump(server) for server in dirty_guilds}
+    dirty_guilds.clear()
+    return snapshot
+
+# Write the snapshot to storage. Runs in a worker thread.
+# Returns the servers that couldn't be written.
+def write_mappings(snapshot):
+    return storage.write(snapshot)
+
+# Instantiate the assignment index.
+# Stores all the servers, roles, channels and messages. A server's messages are compiled into templates the first time it's needed.
+assignments = AssignmentIndex()
 
 # Command for assigning an announcement channel when someone gains a role.
 @bot.slash_command(
@@ -79,38 +960,101 @@ role_channel_mapping = load_mappings()
 async def assign_role_and_channel(ctx: discord.ApplicationContext,
                                   role: Option(discord.Role, "The role it should check for.", required=True),
                                   channel: Option(discord.TextChannel, "The channel it should send a message to.", required=False) = None,
-                                  message: Option(str, "The message it should send.", required=False) = "{user_mention} got the {role_name} role!! 🎉"
+                                  message: Option(str, "The message it should send.", required=False) = "{user_mention} got the {role_name} role!! 🎉",
+                                  coalesce: Option(bool, "Combine promotions that happen close together into one message.", required=False) = False
                                   ):
-    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Issued new assignment.\n")
+    log.info("Issued new assignment.")
     # If no channel is given, default to the one the command was run in.
     channel = channel or ctx.channel
     if channel == ctx.channel:
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Defaulted to channel the command ran in.\n")
-    # Turn parameter IDs to strings. They're normally integers, this is to avoid converting them Every time they are used.
-    str_guild_id = str(ctx.guild.id)
-    str_role_id = str(role.id)
-    str_channel_id = str(channel.id)
-    # If the server/role/channel doesn't exist in the json file already, add it.
-    if str_guild_id not in role_channel_mapping.keys():
-        role_channel_mapping.update({str_guild_id: {}})
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Server doesn't exist in the file: {bot.get_guild(ctx.guild.id)}. Added server to mapping.\n")
-    if str_role_id not in role_channel_mapping[str_guild_id].keys():
-        role_channel_mapping[str_guild_id].update({str_role_id: {}})
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Role doesn't exist in the file: {bot.get_guild(ctx.guild.id).get_role(role.id)}. Added role to mapping.\n")
-    # If the channel doesn't exist, create a list for messages, otherwise add the message to the list.
-    if str_channel_id not in role_channel_mapping[str_guild_id][str_role_id]:
-        role_channel_mapping[str_guild_id][str_role_id].update({str_channel_id: [message]})
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Channel doesn't exist in the file: {bot.get_channel(channel.id)}. Added channel to mapping\n")
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Assigned message successfully.\n")
-    else:
-        role_channel_mapping[str_guild_id][str_role_id][str_channel_id].append(message)
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Assigned message successfully.\n")
+        log.info("Defaulted to channel the command ran in.")
+    # Log what's new, then add the assignment to the index. The message gets compiled into a template there.
+    if ctx.guild.id not in assignments:
+        log.info(f"Server doesn't have assignments yet: {ctx.guild}. Added server to mapping.")
+    new_role = role.id not in assignments.roles(ctx.guild.id)
+    if new_role:
+        log.info(f"Role doesn't have assignments yet: {role}. Added role to mapping.")
+    if channel.id not in assignments.roles(ctx.guild.id).get(role.id, {}):
+        log.info(f"Channel doesn't have assignments yet: {channel}. Added channel to mapping")
+    assignments.add(ctx.guild.id, role.id, channel.id, message, coalesce)
+    # In low memory mode, nobody's roles were being kept for the new role, so read the members again.
+    if LOW_MEMORY and new_role:
+        role_cache.seed(ctx.guild)
+    log.info("Assigned message successfully.")
     # Save the new data in the json file.
-    save_mappings()
-    stderr.write("----------====================----------\n")
+    save_mappings(ctx.guild.id)
     # Tell the user the operation succeeded.
     await ctx.respond("Role, channel and message successfully assigned.", ephemeral=True)
 
+# Server -> (index version it was rendered at, pages of /view_assignments), so listing the same assignments twice is free.
+assignment_pages = {}
+
+# Render a server's assignments into pages that each fit in one message, or an empty list if it has none.
+# Roles are written as mentions so the pages never need a role lookup and don't go stale when a role gets renamed.
+def render_assignment_pages(guild_id: int) -> list:
+    roles = assignments.roles(guild_id)
+    version = assignments.versions.get(guild_id)
+    cached = assignment_pages.get(guild_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    # For every role, mention it and the channel and write the messages under them as bullet points.
+    lines = []
+    for role, channels in roles.items():
+        lines.append(f"## <@&{role}>")
+        for channel, templates in channels.items():
+            lines.append(f"<#{channel}>")
+            for template in templates:
+                lines.append(f"- {template.source}{' *(combined)*' if template.coalesce else ''}")
+    # Fill every page with as many lines as fit, leaving room for the page number. Lines that are too long on their own get cut up.
+    limit = MESSAGE_LIMIT - 32
+    pages, page, length = [], [], 0
+    for line in lines:
+        for start in range(0, max(len(line), 1), limit):
+            piece = line[start:start + limit]
+            if page and length + len(piece) + 1 > limit:
+                pages.append("\n".join(page))
+                page, length = [], 0
+            page.append(piece)
+            length += len(piece) + 1
+    if page:
+        pages.append("\n".join(page))
+    assignment_pages[guild_id] = (version, pages)
+    return pages
+
+# Buttons for flipping through the pages of /view_assignments.
+class AssignmentPagesView(discord.ui.View):
+    def __init__(self, pages: list):
+        super().__init__(timeout=300) # Times out after 5 minutes.
+        self.pages = pages
+        self.page = 0
+        self.update_buttons()
+
+    # The current page with its page number under it.
+    def content(self) -> str:
+        return f"{self.pages[self.page]}\n-# Page {self.page + 1} of {len(self.pages)}"
+
+    # Can't go back from the first page or forward from the last one.
+    def update_buttons(self):
+        self.previous_button_callback.disabled = self.page == 0
+        self.next_button_callback.disabled = self.page == len(self.pages) - 1
+
+    @discord.ui.button(label="Previous", row=0, style=discord.ButtonStyle.secondary)
+    async def previous_button_callback(self, button, interaction):
+        self.page -= 1
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    @discord.ui.button(label="Next", row=0, style=discord.ButtonStyle.secondary)
+    async def next_button_callback(self, button, interaction):
+        self.page += 1
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    async def on_timeout(self):
+        # Disable the buttons, the page stays readable.
+        self.disable_all_items()
+        await self.message.edit(view=self)
+
 # Command for viewing all of the assignments in a server.
 @bot.slash_command(
     name="view_assignments",
@@ -118,44 +1062,38 @@ async def assign_role_and_channel(ctx: discord.ApplicationContext,
 )
 @discord.default_permissions(administrator=True)
 async def view_assignments(ctx: discord.ApplicationContext):
-    # Initiate an output.
-    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Issued assignments list in {bot.get_guild(ctx.guild.id)}.\n")
-    output = ""
-    # Only check the current server.
-    for server in role_channel_mapping.keys():
-        if server == str(ctx.guild.id):
-            # For every role, write the name of it, mention the channel and write the messages under them as bullet points.
-            for role in role_channel_mapping[server].keys():
-                output += f"## {ctx.guild.get_role(int(role))}\n"
-                for channel in role_channel_mapping[server][role].keys():
-                    output += f"<#{channel}>\n"
-                    for message in role_channel_mapping[server][role][channel]:
-                        output += f"- {message}\n"
+    log.info(f"Issued assignments list in {ctx.guild.name}.")
+    pages = render_assignment_pages(ctx.guild.id)
     # If there are no assignments, tell the user that.
-    if not output:
+    if not pages:
         await ctx.respond("No assignments have been made in this server.", ephemeral=True)
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING: No assignments in the server.\n----------====================----------\n")
-    # Otherwise send complete output.
+        log.warning("No assignments in the server.")
+    # If it all fits in one message, send just that.
+    elif len(pages) == 1:
+        await ctx.respond(pages[0], ephemeral=True)
+        log.info("Output given.")
+    # Otherwise send the first page with buttons for the rest.
     else:
-        await ctx.respond(output, ephemeral=True)
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Output given.\n----------====================----------\n")
+        view = AssignmentPagesView(pages)
+        await ctx.respond(view.content(), view=view, ephemeral=True)
+        log.info(f"Output given in {len(pages)} pages.")
 
 # Buttons for removing assignments.
 class RemoveAssignmentsView(discord.ui.View):
     # Parameters.
-    def __init__(self, output: str, mapping: dict, assignment: str, func):
+    def __init__(self, output: str, missing: str, func):
         super().__init__(timeout=300) # Times out after 5 minutes.
         self.output = output
-        self.mapping = mapping
-        self.assignment = assignment
-        # func will be the helper function that removes the data from the mapping. It will take the other 3 parameters as arguments.
+        # What to tell the user if there turns out to be nothing to remove.
+        self.missing = missing
+        # func will be the function that removes the data from the assignment index. It returns whether anything was removed.
         self.func = func
 
     # Add a button for cancelling the operation.
     @discord.ui.button(label="No, don't do that", row=0, style=discord.ButtonStyle.success)
     async def cancel_button_callback(self, button, interaction):
         # Disable the buttons after clicking.
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Cancelled removal.\n----------====================----------\n")
+        log.info("Cancelled removal.")
         self.disable_all_items()
         await interaction.response.edit_message(view=self)
         # Fair enough
@@ -165,32 +1103,28 @@ class RemoveAssignmentsView(discord.ui.View):
     @discord.ui.button(label="Yes, I'm sure", row=0, style=discord.ButtonStyle.danger)
     async def confirm_button_callback(self, button, interaction):
         # Disable the buttons after click.
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Confirmed removal.\n----------====================----------\n")
+        log.info("Confirmed removal.")
         self.disable_all_items()
         await interaction.response.edit_message(view=self)
-        # Helper function to remove the assignments.
-        await self.func(interaction = interaction,
-                        mapping = self.mapping,
-                        assignment = self.assignment,
-                        output = self.output)
-        save_mappings()
+        try:
+            # Remove the assignments, then save and confirm if there was anything to remove.
+            if self.func():
+                save_mappings(interaction.guild.id)
+                await interaction.followup.send(self.output, ephemeral=True)
+            else:
+                log.warning(f"Couldn't remove assignment: {self.missing}")
+                await interaction.followup.send(self.missing, ephemeral=True)
+        except Exception:
+            # Error handling. Log to console, then tell the user.
+            log.exception("Error removing assignment.")
+            await interaction.followup.send("There was an error removing the assignment!", ephemeral=True)
 
     async def on_timeout(self):
         # Disable buttons, log the timeout and notify the user.
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING: Assignment removal timed out.\n----------====================----------\n")
+        log.warning("Assignment removal timed out.")
         self.disable_all_items()
         await self.message.edit(content="Why you ghosting me (Timed out)", view=self)
 
-# Helper function that removes a dictionary from the mapping.
-async def generic_helper(interaction, mapping, assignment, output, *args, **kwargs):
-    try:
-        mapping.pop(assignment)
-        await interaction.followup.send(output, ephemeral=True)
-    except Exception as e:
-        # Error handling. Log to console, then tell the user.
-        stderr.write(f"\n{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR REMOVING ASSIGNMENT:\n\n{e.with_traceback(exception().__traceback__)}\n\n")
-        await interaction.followup.send("There was an error removing the assignment!", ephemeral=True)
-
 # Command for removing assignments in a server.
 @bot.slash_command(
     name="remove_assignment",
@@ -203,111 +1137,52 @@ async def remove_role_channel_assignment(ctx: discord.ApplicationContext,
                                          channel: Option(discord.TextChannel, "The channel where it sends messages.", required=False) = None,
                                          message: Option(str, "The message it sends.", required=False) = None):
     # Log the request.
-    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Issued assignment removal in {bot.get_guild(ctx.guild.id).name}.\n")
-    # Turn parameter IDs to strings. They're normally integers, this is to avoid converting them every time they are used.
-    str_guild_id = str(ctx.guild.id)
-    if str_guild_id in role_channel_mapping.keys():
-        if role:
-            str_role_id = str(role.id)
-            str_role_name = str(role)
-        if channel:
-            str_channel_id = str(channel.id)
-
+    log.info(f"Issued assignment removal in {ctx.guild.name}.")
+    guild_id = ctx.guild.id
+    if guild_id in assignments:
         # Check if the parameters exist.
         parameter_existence = (bool(role), bool(channel), bool(message))
 
-        # Helper function that removes a message from the mapping.
-        async def remove_message_helper(interaction, mapping, output, *args, **kwargs):
-            try:
-                # If the message is in the file,
-                if message in mapping:
-                    # And the message is the only assignment there,
-                    if mapping == [message]:
-                        # Remove the entire channel from the file,
-                        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Message is the only element in the mapping. Removing channel assignment.\n")
-                        role_channel_mapping[str_guild_id][str_role_id].pop(str_channel_id)
-                    # Otherwise remove just the message.
-                    else:
-                        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Removing message assignment.")
-                        mapping.remove(message)
-                    await interaction.followup.send(output, ephemeral=True)
-                # If the message isn't in the file, notify the user.
-                else:
-                    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING: Message not in assignment.\n")
-                    await interaction.followup.send("Message not in assignment.", ephemeral=True)
-            except Exception as e:
-                # Error handling. Log to console, then tell the user.
-                stderr.write(f"\n{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR REMOVING ASSIGNMENT:\n{e.with_traceback(exception().__traceback__)}\n\n")
-                await interaction.followup.send("There was an error removing the assignment!", ephemeral=True)
-
-        # Helper function for removing a channel from the mappings.
-        async def remove_channel_helper(interaction, mapping, output, *args, **kwargs):
-            try:
-                # Initialize check for assignment,
-                channel_has_assignment = False
-                # Create a copy of the server's assignments to prevent changing the iterator size,
-                shadow_mapping = mapping.copy()
-                # And for every role in that copy,
-                for selected_role in shadow_mapping:
-                    # If it has an assignment in that channel,
-                    if str_channel_id in mapping[selected_role].keys():
-                        # Set the check to True,
-                        channel_has_assignment = True
-                        # And if it's the only channel left in that assignment,
-                        if list(mapping[selected_role].keys()) == [str_channel_id]:
-                            # Remove the assigned role,
-                            mapping.pop(selected_role)
-                        else:
-                            # Otherwise remove just that assigned channel.
-                            mapping[selected_role].pop(str_channel_id)
-                # If the channel isn't present in the server's assignments,
-                if not channel_has_assignment:
-                    # Log and notify the user.
-                    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING REMOVING ASSIGNMENT: Channel has no assignments.\n")
-                    await interaction.followup.send("That channel doesn't have any assignments.", ephemeral=True)
-                else:
-                    # Otherwise confirm deletion.
-                    await interaction.followup.send(output, ephemeral=True)
-            except Exception as e:
-                # Error handling. Log to console, then tell the user.
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} ERROR REMOVING ASSIGNMENT:\n\n{e.with_traceback(exception().__traceback__)}\n\n")
-                await interaction.followup.send("There was an error removing the assignment!", ephemeral=True)
-
         # Do something when certain parameters exist.
         match parameter_existence:
             # No given parameters, delete everything.
             case (False, False, False):
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Requested removal of all assignments.\n")
+                log.info("Requested removal of all assignments.")
                 await ctx.respond("Are you ***absolutely sure*** that you want to delete ***EVERY*** assignment?\n*This cannot be reversed!*",
                                 view=RemoveAssignmentsView("Deleted every assignment successfully.",
-                                                            role_channel_mapping, str_guild_id, generic_helper), ephemeral=True)
+                                                           "This server doesn't have any assignments.",
+                                                           lambda: assignments.remove_guild(guild_id)), ephemeral=True)
             # Role param given, remove role assignment.
             case (True, False, False):
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Requested removal of role assignment.\n")
-                await ctx.respond(f"Are you *sure* you want to delete all the assignments made to the {str_role_name} role?",
-                                view=RemoveAssignmentsView(f"Deleted every assignment to the {str_role_name} role successfully.",
-                                                            role_channel_mapping[str_guild_id], str_role_id, generic_helper), ephemeral=True)
+                log.info("Requested removal of role assignment.")
+                await ctx.respond(f"Are you *sure* you want to delete all the assignments made to the {role} role?",
+                                view=RemoveAssignmentsView(f"Deleted every assignment to the {role} role successfully.",
+                                                           "That role doesn't have any assignments.",
+                                                           lambda: assignments.remove_role(guild_id, role.id)), ephemeral=True)
             # Role and channel params given, remove the role assignment from that channel.
             case (True, True, False):
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Requested removal of role and channel assignment.\n")
-                await ctx.respond(f"Are you *sure* you want to delete all the assignments from {str_role_name} in {channel.mention}?",
-                                view=RemoveAssignmentsView(f"Deleted every assignment from {str_role_name} in {channel.mention} successfully.",
-                                                            role_channel_mapping[str_guild_id][str_role_id], "", generic_helper), ephemeral=True)
+                log.info("Requested removal of role and channel assignment.")
+                await ctx.respond(f"Are you *sure* you want to delete all the assignments from {role} in {channel.mention}?",
+                                view=RemoveAssignmentsView(f"Deleted every assignment from {role} in {channel.mention} successfully.",
+                                                           "That role doesn't have any assignments in that channel.",
+                                                           lambda: assignments.remove_role_channel(guild_id, role.id, channel.id)), ephemeral=True)
             # Every parameter given, remove a specific message.
             case (True, True, True):
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Requested removal of message assignment.\n")
-                await ctx.respond(f"Are you sure you want to remove the following message from {str_role_name} in {channel.mention}?\n{message}",
-                                view=RemoveAssignmentsView(f'Deleted "{message}" from {str_role_name} in {channel.mention} successfully.',
-                                                            role_channel_mapping[str_guild_id][str_role_id][str_channel_id], "", remove_message_helper), ephemeral=True)
+                log.info("Requested removal of message assignment.")
+                await ctx.respond(f"Are you sure you want to remove the following message from {role} in {channel.mention}?\n{message}",
+                                view=RemoveAssignmentsView(f'Deleted "{message}" from {role} in {channel.mention} successfully.',
+                                                           "Message not in assignment.",
+                                                           lambda: assignments.remove_message(guild_id, role.id, channel.id, message)), ephemeral=True)
             # Just the channel given, remove every assignment in that channel.
             case (False, True, False):
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Requested removal of channel assignment.\n")
+                log.info("Requested removal of channel assignment.")
                 await ctx.respond(f"Are you sure you want to remove every assignment in {channel.mention}?",
                                 view=RemoveAssignmentsView(f'Deleted every assignment in {channel.mention} successfully.',
-                                                            role_channel_mapping[str_guild_id], "", remove_channel_helper), ephemeral=True)
+                                                           "That channel doesn't have any assignments.",
+                                                           lambda: assignments.remove_channel(guild_id, channel.id)), ephemeral=True)
             # In every other case, send the berlin wall of text.
             case _:
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING REMOVING ASSIGNMENT: Invalid parameters.\n----------====================----------\n")
+                log.warning("Couldn't remove assignment: Invalid parameters.")
                 await ctx.respond("""i can't work with those parameters man
 
     **No parameters** to remove every assignment in the server.
@@ -316,9 +1191,195 @@ async def remove_role_channel_assignment(ctx: discord.ApplicationContext,
     **Role**, **channel** and **message** parameters to remove a specific message.
     Only **channel** parameter to remove every assignment made in that channel.""", ephemeral=True)
     else:
-        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- WARNING REMOVING ASSIGNMENT: Server {bot.get_guild(ctx.guild.id).name} has no assignments.\n----------====================----------\n")
+        log.warning(f"Couldn't remove assignment: Server {ctx.guild.name} has no assignments.")
         await ctx.respond("This server has no assignments! Make some with /assign", ephemeral=True)
 
+# Biggest import file that gets read, in bytes.
+IMPORT_MAX_SIZE = 1024 * 1024
+# How many lines of the import preview are shown before the rest gets summed up.
+IMPORT_PREVIEW_LINES = 20
+
+# Command for downloading every assignment in a server as a json file, to back them up or /import_assignments them somewhere else.
+@bot.slash_command(
+    name="export_assignments",
+    description="Download all the assignments made in your server as a file."
+)
+@discord.default_permissions(administrator=True)
+async def export_assignments(ctx: discord.ApplicationContext):
+    log.info(f"Issued assignments export in {ctx.guild.name}.")
+    dump = assignments.dump(ctx.guild.id)
+    if dump is None:
+        log.warning("No assignments in the server.")
+        await ctx.respond("No assignments have been made in this server.", ephemeral=True)
+        return
+    # The names go along with the IDs so the file can be imported into a server where the IDs are different.
+    roles = dump[str(ctx.guild.id)]
+    export = {"roles": {role: getattr(ctx.guild.get_role(int(role)), "name", None) for role in roles},
+              "channels": {channel: getattr(ctx.guild.get_channel(int(channel)), "name", None)
+                           for channels in roles.values() for channel in channels},
+              "assignments": roles}
+    file = discord.File(BytesIO(json.dumps(export, indent=4, ensure_ascii=False).encode()), filename=f"assignments-{ctx.guild.id}.json")
+    await ctx.respond("Here are all the assignments in this server. Use /import_assignments to load them into a server.", file=file, ephemeral=True)
+    log.info("Export given.")
+
+# Check an import file against a server. Returns the assignments in it as (role, channel, message, coalesce) and a list of everything wrong with it.
+# Roles and channels are looked up by ID first, then by the name saved next to it, so a file exported from another server still works.
+def resolve_import(guild: discord.Guild, data) -> tuple:
+    entries, problems = [], []
+    if not isinstance(data, dict):
+        return entries, ["The file isn't an assignments export."]
+    # Also take the bare role -> channel -> messages format, which is what's in the storage files.
+    roles = data["assignments"] if isinstance(data.get("assignments"), dict) else data
+    role_names = {key: name for key, name in data["roles"].items() if isinstance(name, str)} if isinstance(data.get("roles"), dict) else {}
+    channel_names = {key: name for key, name in data["channels"].items() if isinstance(name, str)} if isinstance(data.get("channels"), dict) else {}
+    text_channels = {channel.name: channel for channel in guild.text_channels}
+    for role_key, channels in roles.items():
+        role = guild.get_role(int(role_key)) if role_key.isascii() and role_key.isdigit() else None
+        role = role or discord.utils.get(guild.roles, name=role_names.get(role_key))
+        if role is None:
+            problems.append(f"Role {role_names.get(role_key) or role_key} isn't in this server.")
+            continue
+        if not isinstance(channels, dict):
+            problems.append(f"The assignments of {role} aren't in the right format.")
+            continue
+        for channel_key, messages in channels.items():
+            channel = guild.get_channel(int(channel_key)) if channel_key.isascii() and channel_key.isdigit() else None
+            channel = channel or text_channels.get(channel_names.get(channel_key))
+            if not isinstance(channel, discord.TextChannel):
+                problems.append(f"Channel {channel_names.get(channel_key) or channel_key} isn't a text channel in this server.")
+                continue
+            if not isinstance(messages, list):
+                problems.append(f"The messages of {role} in #{channel} aren't a list.")
+                continue
+            for message in messages:
+                if isinstance(message, str):
+                    entries.append((role, channel, message, False))
+                elif isinstance(message, dict) and isinstance(message.get("message"), str):
+                    entries.append((role, channel, message["message"], bool(message.get("coalesce", False))))
+                else:
+                    problems.append(f"A message of {role} in #{channel} isn't text.")
+    return entries, problems
+
+# Buttons for confirming an import.
+class ImportAssignmentsView(discord.ui.View):
+    # Parameters.
+    def __init__(self, output: str, changed: str, func):
+        super().__init__(timeout=300) # Times out after 5 minutes.
+        self.output = output
+        # What to tell the user if the assignments changed since the preview.
+        self.changed = changed
+        # func will be the function that puts the imported assignments in the index. It returns whether it did.
+        self.func = func
+
+    # Add a button for cancelling the import.
+    @discord.ui.button(label="No, don't do that", row=0, style=discord.ButtonStyle.secondary)
+    async def cancel_button_callback(self, button, interaction):
+        # Disable the buttons after clicking.
+        log.info("Cancelled import.")
+        self.disable_all_items()
+        await interaction.response.edit_message(view=self)
+        await interaction.followup.send("fair enough", ephemeral=True)
+
+    # Add a button for confirming the import.
+    @discord.ui.button(label="Yes, import them", row=0, style=discord.ButtonStyle.success)
+    async def confirm_button_callback(self, button, interaction):
+        # Disable the buttons after click.
+        log.info("Confirmed import.")
+        self.disable_all_items()
+        await interaction.response.edit_message(view=self)
+        try:
+            # Apply everything at once, then save the server a single time.
+            if self.func():
+                save_mappings(interaction.guild.id)
+                await interaction.followup.send(self.output, ephemeral=True)
+            else:
+                log.warning("Couldn't import assignments: They changed since the preview.")
+                await interaction.followup.send(self.changed, ephemeral=True)
+        except Exception:
+            # Error handling. Log to console, then tell the user.
+            log.exception("Error importing assignments.")
+            await interaction.followup.send("There was an error importing the assignments!", ephemeral=True)
+
+    async def on_timeout(self):
+        # Disable buttons, log the timeout and notify the user.
+        log.warning("Assignment import timed out.")
+        self.disable_all_items()
+        await self.message.edit(content="Why you ghosting me (Timed out)", view=self)
+
+# Command for loading a whole file of assignments into a server at once, instead of running /assign for every one of them.
+@bot.slash_command(
+    name="import_assignments",
+    description="Add all the assignments from a file made with /export_assignments."
+)
+@discord.default_permissions(administrator=True)
+async def import_assignments(ctx: discord.ApplicationContext,
+                             file: Option(discord.Attachment, "The file made with /export_assignments.", required=True),
+                             replace: Option(bool, "Remove every assignment that isn't in the file.", required=False) = False):
+    log.info(f"Issued assignments import in {ctx.guild.name}.")
+    guild_id = ctx.guild.id
+    if file.size > IMPORT_MAX_SIZE:
+        log.warning(f"Couldn't import assignments: File is {file.size} bytes.")
+        await ctx.respond("That file is way too big to be assignments.", ephemeral=True)
+        return
+    try:
+        data = json.loads(await file.read())
+    except (discord.HTTPException, ValueError):
+        log.warning("Couldn't import assignments: File isn't json.")
+        await ctx.respond("I can't read that file, it should be the one /export_assignments gives you.", ephemeral=True)
+        return
+    # Check the whole file before changing anything, so it's either all imported or none of it.
+    entries, problems = resolve_import(ctx.guild, data)
+    if problems:
+        log.warning(f"Couldn't import assignments: {len(problems)} problems.")
+        shown = "\n".join(f"- {problem}" for problem in problems[:IMPORT_PREVIEW_LINES])
+        more = f"\n...and {len(problems) - IMPORT_PREVIEW_LINES} more." if len(problems) > IMPORT_PREVIEW_LINES else ""
+        await ctx.respond(f"Nothing was imported, fix these first:\n{shown}{more}"[:MESSAGE_LIMIT], ephemeral=True)
+        return
+    # Work out what changes: messages already assigned are skipped, and with replace everything not in the file goes.
+    current = list(dict.fromkeys((role, channel, template.source, template.coalesce)
+                                 for role, channels in assignments.roles(guild_id).items()
+                                 for channel, templates in channels.items() for template in templates))
+    existing = set(current)
+    imported = {(role.id, channel.id, message, coalesce) for role, channel, message, coalesce in entries}
+    added = [entry for entry in dict.fromkeys(entries) if (entry[0].id, entry[1].id, entry[2], entry[3]) not in existing]
+    removed = [entry for entry in current if entry not in imported] if replace else []
+    if not added and not removed:
+        log.info("Import doesn't change anything.")
+        await ctx.respond("This server already has every assignment in that file.", ephemeral=True)
+        return
+    # Show a preview of the changes.
+    lines = [f"+ {role.mention} {channel.mention}: {message}{' *(combined)*' if coalesce else ''}" for role, channel, message, coalesce in added]
+    lines += [f"- <@&{role}> <#{channel}>: {message}{' *(combined)*' if coalesce else ''}" for role, channel, message, coalesce in removed]
+    preview = "\n".join(line[:200] for line in lines[:IMPORT_PREVIEW_LINES])
+    if len(lines) > IMPORT_PREVIEW_LINES:
+        preview += f"\n...and {len(lines) - IMPORT_PREVIEW_LINES} more."
+    summary = f"This will add {len(added)} and remove {len(removed)} assignments." if replace else f"This will add {len(added)} assignments."
+    new_roles = {role.id for role, _, _, _ in added} - set(assignments.roles(guild_id))
+    # The preview is only right as long as nothing else changes the server's assignments.
+    version = assignments.versions.get(guild_id)
+
+    def apply():
+        if assignments.versions.get(guild_id) != version:
+            return False
+        # Nothing gets awaited in here, so no member update can see a half imported server.
+        if replace:
+            assignments.remove_guild(guild_id)
+            for role_id, channel_id, message, coalesce in current:
+                if (role_id, channel_id, message, coalesce) in imported:
+                    assignments.add(guild_id, role_id, channel_id, message, coalesce)
+        for role, channel, message, coalesce in added:
+            assignments.add(guild_id, role.id, channel.id, message, coalesce)
+        # In low memory mode, nobody's roles were being kept for the new roles, so read the members again.
+        if LOW_MEMORY and new_roles:
+            role_cache.seed(ctx.guild)
+        log.info(f"Imported {len(added)} assignments, removed {len(removed)}.")
+        return True
+
+    await ctx.respond(f"{summary} Are you sure?\n{preview}"[:MESSAGE_LIMIT],
+                      view=ImportAssignmentsView("Imported the assignments successfully.",
+                                                 "The assignments in this server changed since this preview, run /import_assignments again.",
+                                                 apply), ephemeral=True)
+
 # Command that shows all the tokens that are able to be used with the /assign command and how to use /assign and /remove_assignment.
 @bot.slash_command(
     name="help",
@@ -327,11 +1388,11 @@ async def remove_role_channel_assignment(ctx: discord.ApplicationContext,
 @discord.default_permissions(administrator=True)
 # It literally just sends one message. There is no logic behind this. This comment is useless.
 async def help(ctx: discord.ApplicationContext):
-    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Issued help command in {bot.get_guild(ctx.guild.id).name}.\n----------====================----------\n")
+    log.info(f"Issued help command in {ctx.guild.name}.")
     await ctx.respond("""
-There are only three other commands, `/assign`, `/view_assignments` and `/remove_assignment`.
+There are only six other commands, `/assign`, `/view_assignments`, `/remove_assignment`, `/export_assignments`, `/import_assignments` and `/stats`.
 
-When using /assign, you can leave out the channel to default to the channel you ran the command in, or the message to default to a fallback message. In the message, you can use the following tokens:
+When using /assign, you can leave out the channel to default to the channel you ran the command in, or the message to default to a fallback message. Set coalesce to True to combine promotions that happen within a few seconds of each other into one message, the user tokens then list every member. In the message, you can use the following tokens:
 **{user_mention} —** Pings the user that got the role.
 **{user_tag} —** Writes the handle of the user that got the role.
 **{user_name}** — Writes the display name of the user that got the role.
@@ -345,51 +1406,188 @@ When using /remove_assignment, here are the possible parameter combinations:
 **Role** parameter to remove every assignment to that role.
 **Role** and **channel** parameters to remove every assignment of that role in that channel.
 **Role**, **channel** and **message** parameters to remove a specific message.
-Only **channel** parameter to remove every assignment made in that channel.""", ephemeral=True)
+Only **channel** parameter to remove every assignment made in that channel.
+
+/export_assignments gives you a file with every assignment in the server. Give that file to /import_assignments to add them all to a server at once, also in a different server, where roles and channels get matched by name. You'll see what changes before anything happens. Set replace to True to also remove every assignment that isn't in the file.""", ephemeral=True)
+
+# Command that shows how the bot is doing: how many member updates it can ignore and how fast announcements go out.
+@bot.slash_command(
+    name="stats",
+    description="Show how many member updates the bot has handled."
+)
+@discord.default_permissions(administrator=True)
+async def stats(ctx: discord.ApplicationContext):
+    log.info(f"Issued stats command in {ctx.guild.name}.")
+    seen, matched = events_seen.total, events_matched.total
+    match_rate = matched / seen * 100 if seen else 0
+    sending = dispatcher.stats()
+    filtering, rendering = sorted(spans["filter"]), sorted(spans["render"])
+    await ctx.respond(f"**Member updates seen:** {seen} ({events_seen.rate():.2f}/s over the last minute)\n"
+                      f"**Member updates that matched an assignment:** {matched} ({match_rate:.2f}%, {events_matched.rate():.2f}/s over the last minute)\n"
+                      f"**Time to filter a matching update:** p50 {percentile(filtering, 50) * 1e6:.0f} µs, p99 {percentile(filtering, 99) * 1e6:.0f} µs\n"
+                      f"**Time to render and queue its messages:** p50 {percentile(rendering, 50) * 1e6:.0f} µs, p99 {percentile(rendering, 99) * 1e6:.0f} µs\n"
+                      f"**Messages waiting to be sent:** {sending['queued']} in {sending['active_channels']} channel(s), {sending['busiest_queue']} in the busiest one\n"
+                      f"**Messages sent:** {sending['sent']} ({sending['failed']} failed, {sending['retried']} retries)\n"
+                      f"**Time from queueing to sent:** p50 {sending['latency_p50'] * 1000:.0f} ms, p99 {sending['latency_p99'] * 1000:.0f} ms\n"
+                      f"**Repeats skipped:** {dedup.hits} of {dedup.hits + dedup.misses} ({len(dedup.entries)} remembered)", ephemeral=True)
 
 # Fun part. What it does when a server member gets a role.
 @bot.event
 async def on_member_update(before, after):
-    global last_message
-    # Save all the roles that were added to a user in this list.
-    added_roles = [role for role in after.roles if role not in before.roles]
-    if added_roles and str(after.guild.id) in role_channel_mapping.keys():
-        for role in added_roles:
-            # If the role is assigned
-            str_role_id, str_guild_id = str(role.id), str(after.guild.id)
-            if str_role_id in role_channel_mapping[str_guild_id].keys():
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- {after.name} updated their roles in {bot.get_guild(after.guild.id).name}.\n")
-                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- {str(role)} has assignment in {bot.get_guild(after.guild.id).name}.\n")
-                # Save all channel IDs and messages to different lists.
-                channel_ids = role_channel_mapping[str_guild_id][str_role_id].keys()
-                for channel in channel_ids:
-                    # Get the actual channel from its ID.
-                    selected_channel = after.guild.get_channel(int(channel))
-                    stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Channel found: {str(selected_channel)}\n")
-                    try:
-                        # For every message assigned to that channel assigned to that role,
-                        for message in role_channel_mapping[str_guild_id][str_role_id][str(channel)]:
-                            # Check for all of these tokens,
-                            special_tokens = {"{user_mention}": after.mention,
-                                              "{user_tag}": after.name,
-                                              "{user_name}": after.display_name,
-                                              "{user_id}": after.id,
-                                              "{role_mention}": role.mention,
-                                              "{role_name}": str(role),
-                                              "{role_id}": role.id}
-                            for x in special_tokens.keys():
-                                # And replace them with the appropriate things,
-                                message = re.sub(x, str(special_tokens[x]), message)
-                            if message == last_message:
-                                stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- Repeat message for {after.name} skipped.\n")
-                            else:
-                                last_message = message
-                                await selected_channel.send(message)
-                    except discord.HTTPException as e:
-                        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR SENDING MESSAGE:\n\n{e.with_traceback(exception().__traceback__)}\n\n")
-                    except Exception as e:
-                        stderr.write(f"{datetime.now().strftime('%H:%M:%S:%f')} -- ERROR ON MEMBER UPDATE:\n\n{e.with_traceback(exception().__traceback__)}\n\n")
-                    finally:
-                        stderr.write("----------====================----------\n")
-
-bot.run(bot_token)
+    # Low memory mode doesn't cache members, so updates come through on_raw_member_update instead.
+    if LOW_MEMORY:
+        return
+    started = time.perf_counter()
+    events_seen.tick()
+    # Check the server first, most updates come from servers without any assignments.
+    watched = assignments.watched_roles(after.guild.id)
+    if not watched:
+        return
+    # _roles is py-cord's sorted array of role IDs. Comparing and intersecting those is much cheaper than building Role objects,
+    # and skips nickname, avatar and timeout updates right away.
+    if before._roles == after._roles:
+        return
+    # Save the IDs of all the watched roles that were added to a user.
+    added_role_ids = watched.intersection(after._roles).difference(before._roles)
+    if added_role_ids:
+        announce(after, added_role_ids, started)
+
+# Same thing for low memory mode, straight from Discord's event, compared against the role cache.
+@bot.event
+async def on_raw_member_update(payload):
+    if not LOW_MEMORY:
+        return
+    started = time.perf_counter()
+    events_seen.tick()
+    watched = assignments.watched_roles(payload.guild_id)
+    if not watched:
+        return
+    added_role_ids = role_cache.update(payload.guild_id, payload.user_id, map(int, payload.data["roles"]), watched)
+    if added_role_ids and payload.guild_id in role_cache.ready:
+        announce(payload.member, added_role_ids, started)
+
+# Members who leave don't need to be remembered.
+@bot.event
+async def on_raw_member_remove(payload):
+    if LOW_MEMORY:
+        role_cache.remove(payload.guild_id, payload.user.id)
+
+# In low memory mode, read the members of every server with assignments once it's available.
+@bot.event
+async def on_guild_available(guild):
+    if LOW_MEMORY and assignments.watched_roles(guild.id):
+        role_cache.seed(guild)
+
+# Send out the announcements for the watched roles a member just got.
+def announce(member, added_role_ids: set, started: float):
+    events_matched.tick()
+    filtered = time.perf_counter()
+    # Debug lines use %-style arguments, so nothing gets formatted unless debug logging is on.
+    log.debug("%s got %d watched role(s) in %s.", member.name, len(added_role_ids), member.guild.name)
+    roles = assignments.roles(member.guild.id)
+    for role_id in added_role_ids:
+        role = member.guild.get_role(role_id)
+        channels = roles.get(role_id)
+        if role and channels:
+            for channel_id, templates in channels.items():
+                # Get the actual channel from its ID.
+                selected_channel = member.guild.get_channel(channel_id)
+                if selected_channel is None:
+                    log.warning(f"Channel {channel_id} doesn't exist anymore.")
+                    continue
+                try:
+                    # For every message assigned to that channel assigned to that role,
+                    for template in templates:
+                        # Skip it if this exact announcement went out recently.
+                        if dedup.seen((member.guild.id, member.id, role_id, channel_id, template)):
+                            log.debug("Repeat message for %s skipped.", member.name)
+                            continue
+                        # Combined announcements are collected for a bit and rendered later,
+                        if template.coalesce:
+                            coalescer.add(selected_channel, role, template, member)
+                            continue
+                        # Otherwise fill in the tokens with the appropriate things,
+                        # and hand the message to the dispatcher, which sends it in the background.
+                        dispatcher.enqueue(selected_channel, template.render(member, role)[:MESSAGE_LIMIT])
+                        log.debug("Queued announcement of %s for %s in %s.", role, member.name, selected_channel)
+                except Exception:
+                    log.exception("Error on member update.")
+    rendered = time.perf_counter()
+    spans["filter"].append(filtered - started)
+    spans["render"].append(rendered - filtered)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Handled member update.", extra={"fields": {"guild_id": member.guild.id, "member_id": member.id,
+                                                              "filter_us": round((filtered - started) * 1e6, 1),
+                                                              "render_us": round((rendered - filtered) * 1e6, 1)}})
+
+# Run the bot as several worker processes, each running its own range of the shards and loading only those servers' assignments.
+# Admin commands always arrive at the worker running the server's shard, so every worker only writes its own servers to the shared storage.
+# Use it with `python promotion.py launch <workers> <shards>`. Workers that crash get restarted.
+# Seconds before a crashed worker is restarted, doubling for every crash in a row, never longer than RESTART_DELAY_MAX.
+RESTART_DELAY = 5.0
+RESTART_DELAY_MAX = 300.0
+
+def launch(workers: int, shard_count: int):
+    if workers < 1 or shard_count < 1:
+        raise ValueError("Need at least one worker and one shard.")
+    workers = min(workers, shard_count)
+    shard_ranges = [list(range(i * shard_count // workers, (i + 1) * shard_count // workers)) for i in range(workers)]
+
+    def start(shard_ids: list):
+        log.info(f"Starting worker for shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}.")
+        return subprocess.Popen([executable, path.abspath(__file__)],
+                                env={**environ, "SHARD_COUNT": str(shard_count), "SHARD_IDS": ",".join(map(str, shard_ids))})
+
+    processes = [start(shard_ids) for shard_ids in shard_ranges]
+    # A worker that keeps crashing waits longer before every restart: RESTART_DELAY seconds, doubling up to RESTART_DELAY_MAX.
+    # Once it stays up for RESTART_DELAY_MAX, the delay goes back to the start.
+    delays = [RESTART_DELAY] * workers
+    started = [time.monotonic()] * workers
+    restart_at = [None] * workers
+    try:
+        while any(process is not None for process in processes):
+            time.sleep(1)
+            now = time.monotonic()
+            for i, process in enumerate(processes):
+                if process is None:
+                    continue
+                if restart_at[i] is not None:
+                    if now >= restart_at[i]:
+                        restart_at[i] = None
+                        started[i] = now
+                        processes[i] = start(shard_ranges[i])
+                    continue
+                if process.poll() is None:
+                    continue
+                if process.returncode == 0:
+                    log.info(f"Worker for shards {shard_ranges[i][0]}-{shard_ranges[i][-1]} stopped.")
+                    processes[i] = None
+                else:
+                    if now - started[i] >= RESTART_DELAY_MAX:
+                        delays[i] = RESTART_DELAY
+                    log.warning(f"Worker for shards {shard_ranges[i][0]}-{shard_ranges[i][-1]} crashed with exit code {process.returncode}, "
+                                f"restarting it in {delays[i]:.0f} seconds.")
+                    restart_at[i] = now + delays[i]
+                    delays[i] = min(delays[i] * 2, RESTART_DELAY_MAX)
+    except KeyboardInterrupt:
+        # Let every worker save and shut down properly.
+        for process in processes:
+            if process is not None:
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                process.wait()
+
+if __name__ == "__main__" and argv[1:] == ["migrate"]:
+    migrate_json_to_sqlite()
+elif __name__ == "__main__" and argv[1:2] == ["launch"]:
+    # Never fall through to running a normal bot on every shard next to the workers.
+    if len(argv) != 4 or not all(arg.isascii() and arg.isdigit() and int(arg) > 0 for arg in argv[2:]):
+        print("Usage: python promotion.py launch <workers> <shards>, both whole numbers above 0.", file=stderr)
+        exit(2)
+    launch(int(argv[2]), int(argv[3]))
+elif __name__ == "__main__":
+    assignments.load_lazily(load_mappings())
+    bot.run(bot_token)
+    # If the bot stopped without closing properly, write whatever is still unsaved.
+    write_mappings(take_dirty_snapshot())